@@ -1,132 +1,266 @@
 import torch
-from torch.utils.data import Dataset, Sampler
+from torch.utils.data import Dataset, Sampler, get_worker_info
 from pathlib import Path
 import numpy as np
-import random
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 import av
+import cv2
 from typing import Dict, List
-import torch.nn as nn
-import torchaudio.transforms as T
+from fractions import Fraction
 import warnings
 warnings.filterwarnings("ignore")
 import multiprocessing
 from torch.utils.data import DataLoader
-# use fork for potentially faster dataloader start
+# forkserver workers fork from a server that never touches CUDA, so they can't inherit the
+# trainer's CUDA context. Workers still re-run the entry script as __mp_main__, so the heavy
+# libraries it imports are preloaded once in the server and shared copy-on-write; '__main__'
+# itself is ignored by the forkserver on older Pythons, and modules that aren't installed are skipped
+_FORKSERVER_PRELOAD = [
+    '__main__', 'numpy', 'torch', 'torchvision', 'av', 'cv2',
+    'transformers', 'timm', 'matplotlib.pyplot', 'wandb',
+]
 try:
-    multiprocessing.set_start_method('fork', force=True)
-except:
+    multiprocessing.set_start_method('forkserver', force=True)
+    multiprocessing.set_forkserver_preload(_FORKSERVER_PRELOAD)
+except ValueError:
     multiprocessing.set_start_method('spawn', force=True)
 import gc
+# dataloader workers already run in parallel; keep OpenCV single-threaded inside each
+cv2.setNumThreads(1)
 # ImageNet normalization constants
 IMAGENET_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(-1, 1, 1)
 IMAGENET_STD = torch.tensor([0.229, 0.224, 0.225]).view(-1, 1, 1)
+# length of a decoded 1s clip after resampling to 16 kHz
+AUDIO_NUM_SAMPLES = 16331
 
-def extract_audio_from_video(video_path: Path) -> torch.Tensor:
-    """Extract entire 1s audio from video."""
+# (x / 255 - mean) / std folded into x * scale - bias
+_NORM_SCALE = (1.0 / 255.0) / IMAGENET_STD
+_NORM_BIAS = IMAGENET_MEAN / IMAGENET_STD
+_NORM_PARAMS = {'cpu': (_NORM_SCALE, _NORM_BIAS)}
+
+# per-process; dataloader workers build it in init_worker
+_HWACCEL = None
+
+def _get_hwaccel():
+    global _HWACCEL
+    if _HWACCEL is None:
+        from av.codec.hwaccel import HWAccel
+        _HWACCEL = HWAccel(device_type='cuda', allow_software_fallback=True)
+    return _HWACCEL
+
+# per-process AudioResamplers keyed by input (format, layout, rate): a resampler is bound to the
+# input it first saw. They are never flushed, as that ends the filter graph, so a few samples of
+# filter delay carry over into the next clip.
+_RESAMPLERS = {}
+
+def _get_resampler(frame):
+    key = (frame.format.name, frame.layout.name, frame.sample_rate)
+    if key not in _RESAMPLERS:
+        _RESAMPLERS[key] = av.audio.resampler.AudioResampler(format='s16', layout='mono', rate=16000)
+    return _RESAMPLERS[key]
+
+def _norm_params(device):
+    if device not in _NORM_PARAMS:
+        _NORM_PARAMS[device] = (_NORM_SCALE.to(device), _NORM_BIAS.to(device))
+    return _NORM_PARAMS[device]
+
+def _frame_to_tensor(frame, device='cpu') -> torch.Tensor:
+    """Resize a decoded frame to 224x224 on the CPU, then normalize it on `device`."""
+    decoded_frame = cv2.resize(frame.to_ndarray(format='rgb24'), (224, 224), interpolation=cv2.INTER_LINEAR)
+    scale, bias = _norm_params(device)
+    frame_tensor = torch.from_numpy(decoded_frame).to(device).permute(2, 0, 1)
+    frame_tensor = frame_tensor.to(torch.float32).mul_(scale).sub_(bias)
+    return frame_tensor
+
+def init_worker(worker_id):
+    """DataLoader worker_init_fn: build per-worker decode state before the first sample."""
+    dataset = get_worker_info().dataset
+    if dataset.hwaccel:
+        _get_hwaccel()
+
+def dequantize_audio(audio: torch.Tensor) -> torch.Tensor:
+    """int16 PCM -> float waveform in [-1, 1]; apply after moving the audio to the device."""
+    return audio.to(torch.float32).mul_(1.0 / 32768.0)
+
+def _probe_video(video_path):
+    """Return (fps, time_base, num_frames) of the video stream, or None if it can't be read."""
     try:
-        container = av.open(str(video_path))
-        audio = container.streams.audio[0]
-        resampler = av.audio.resampler.AudioResampler(format='s16', layout='mono', rate=16000)
-        
-        samples = []
-        for frame in container.decode(audio):
-            frame.pts = None
-            frame = resampler.resample(frame)[0]
-            samples.append(frame.to_ndarray().reshape(-1))
-        container.close()
+        with av.open(str(video_path)) as container:
+            video_stream = container.streams.video[0]
+            return float(video_stream.average_rate), video_stream.time_base, video_stream.frames
+    except Exception:
+        return None
 
-        samples = torch.tensor(np.concatenate(samples))
-        samples = samples.float() / 32768.0  
-        return samples
-    except:
-        print(f"Failed to load audio from {video_path}")
-        return torch.zeros(16331)
+def load_av(video_path: str, sample_fps: int, hwaccel: bool = False, device='cpu', metadata=None):
+    """Decode the entire 1s audio and one random frame from a single container open.
+    With hwaccel, video is decoded on NVDEC (falling back to software if unsupported).
+    The frame is normalized on `device`; keep it 'cpu' inside dataloader workers.
+    `metadata` is the cached (fps, time_base, num_frames) of the file, read from the stream if None.
+    Audio is returned as raw int16 PCM; see dequantize_audio."""
+    open_kwargs = {'hwaccel': _get_hwaccel()} if hwaccel else {}
+    container = av.open(str(video_path), **open_kwargs)
+    try:
+        video_stream = container.streams.video[0]
+        audio_stream = container.streams.audio[0]
+        if metadata is None:
+            metadata = (float(video_stream.average_rate), video_stream.time_base, video_stream.frames)
+        original_fps, time_base, num_original_frames = metadata
+        video_duration = 1.0
+        if not num_original_frames:
+            num_original_frames = int(round(original_fps * video_duration))
+        desired_frame_count = int(video_duration * sample_fps)  # equals sample_fps
+        frame_indices = np.linspace(0, num_original_frames - 1, desired_frame_count, dtype=int)
+        chosen_index = frame_indices[np.random.randint(0, desired_frame_count)]
+        chosen_time_seconds = chosen_index / original_fps
+        chosen_pts = int(chosen_time_seconds / time_base)
+
+        # fixed length so batches stack without padding; short clips stay zero-padded
+        audio = torch.zeros(AUDIO_NUM_SAMPLES, dtype=torch.int16)
+        audio_np = audio.numpy()  # shares memory with `audio`
+        offset = 0
+        closest_frame = None
+        video_done = False
+        # no seek: the audio track is needed from the start, and the 1s clips are short
+        for packet in container.demux(video_stream, audio_stream):
+            if packet.stream.type == 'audio':
+                if offset == AUDIO_NUM_SAMPLES:
+                    continue
+                for frame in packet.decode():
+                    frame.pts = None
+                    # a long-lived resampler may hand back zero or several frames per input frame
+                    for resampled in _get_resampler(frame).resample(frame):
+                        # s16 mono is packed in one plane: view it in place, the only copy is into audio
+                        pcm = np.frombuffer(resampled.planes[0], dtype=np.int16, count=resampled.samples)
+                        n = min(pcm.shape[0], AUDIO_NUM_SAMPLES - offset)
+                        audio_np[offset:offset + n] = pcm[:n]
+                        offset += n
+            elif not video_done:
+                # frames come out in presentation order, so the first one at or past the target
+                # and the one before it are the only candidates
+                for frame in packet.decode():
+                    if frame.pts >= chosen_pts:
+                        if closest_frame is None or frame.pts - chosen_pts <= chosen_pts - closest_frame.pts:
+                            closest_frame = frame
+                        video_done = True
+                        break
+                    closest_frame = frame
     finally:
-        if container:
-            container.close()
-        #gc.collect()
-        #torch.cuda.empty_cache()
-
-def load_and_preprocess_video(video_path: str, sample_fps: int) -> torch.Tensor:
-    """Load only one random frame from the 1s video using PyAV, resize, and normalize."""
-    container = av.open(video_path)
-    video_stream = container.streams.video[0]
-    original_fps = float(video_stream.average_rate)
-    video_duration = 1.0
-    num_original_frames = int(round(original_fps * video_duration))
-    desired_frame_count = int(video_duration * sample_fps)  # equals sample_fps
-    frame_indices = np.linspace(0, num_original_frames - 1, desired_frame_count, dtype=int)
-    chosen_index = frame_indices[np.random.randint(0, desired_frame_count)]
-    chosen_time_seconds = chosen_index / original_fps
-    chosen_pts = int(chosen_time_seconds / video_stream.time_base)
-
-    container.seek(chosen_pts, stream=video_stream, any_frame=False, backward=True)
-    closest_frame = None
-    min_pts_diff = float('inf')
-    for frame in container.decode(video_stream):
-        pts_diff = abs(frame.pts - chosen_pts)
-        if pts_diff < min_pts_diff:
-            min_pts_diff = pts_diff
-            closest_frame = frame
-        # gone too far past our target, stop
-        if frame.pts > chosen_pts + original_fps/10:  # 1/10th second overshoot
-            break
-    
-    container.close()
+        container.close()
+
     if closest_frame is None:
         raise ValueError(f"Failed to find appropriate frame for index {chosen_index}")
-    decoded_frame = closest_frame.to_rgb().to_ndarray()
-    frame_tensor = torch.from_numpy(decoded_frame).permute(2, 0, 1).float() / 255.0
-    frame_tensor = torch.nn.functional.interpolate(
-        frame_tensor.unsqueeze(0), size=(224, 224), mode='bilinear', align_corners=False
-    ).squeeze(0)
-    frame_tensor = (frame_tensor - IMAGENET_MEAN) / IMAGENET_STD
-    return frame_tensor
+    frame_tensor = _frame_to_tensor(closest_frame, device)
+
+    return frame_tensor, audio
 
 class VideoBatchSampler(Sampler):  #point is to sample videos with different vid_nums in a batch
     def __init__(self, vid_nums: List[int], batch_size: int):
-        self.vid_nums = np.array(vid_nums)
+        self.vid_nums = np.asarray(vid_nums)
         self.batch_size = batch_size
         self.total_samples = len(vid_nums)
+        # rank of each sample within its vid_num group, for indices laid out group after group
+        _, self.group_ids, group_counts = np.unique(self.vid_nums, return_inverse=True, return_counts=True)
+        group_starts = np.cumsum(group_counts) - group_counts
+        self.ranks = np.arange(self.total_samples) - np.repeat(group_starts, group_counts)
+        # layer r takes one sample from every video with more than r segments, so no vid repeats inside it
+        self.layer_sizes = np.bincount(self.ranks)
 
     def __iter__(self):
-        all_indices = list(range(self.total_samples))
-        random.shuffle(all_indices)
-        
-        current_batch = []
-        used_vids = set()
-        
-        for idx in all_indices:
-            vid = self.vid_nums[idx]
-            if vid not in used_vids:
-                current_batch.append(idx)
-                used_vids.add(vid)
-                if len(current_batch) == self.batch_size:
-                    yield current_batch
-                    current_batch = []
-                    used_vids = set()
-        
-        if current_batch:
-            yield current_batch
-    
+        perm = np.random.permutation(self.total_samples)
+        grouped = perm[np.argsort(self.group_ids[perm], kind='stable')]
+        layered = grouped[np.lexsort((np.random.random(self.total_samples), self.ranks))]
+
+        batches = []
+        start = 0
+        for layer_size in self.layer_sizes:
+            num_batches = layer_size // self.batch_size
+            layer = layered[start:start + num_batches * self.batch_size]
+            batches.extend(layer.reshape(num_batches, self.batch_size))
+            start += layer_size
+
+        for i in np.random.permutation(len(batches)):
+            yield batches[i].tolist()
+
     def __len__(self):
-        return self.total_samples // self.batch_size
+        return int((self.layer_sizes // self.batch_size).sum())
 
 class AudioVisualDataset(Dataset):
-    def __init__(self, data_root: str, sample_fps: int = 20):
+    def __init__(self, data_root: str, sample_fps: int = 20, hwaccel: bool = False):
         self.data_root = Path(data_root)
         self.sample_fps = sample_fps
+        self.hwaccel = hwaccel
         self.video_files = sorted(list(self.data_root.glob("*.mp4")))
         
-        self.vid_to_files = {}
-        for file in self.video_files:
-            vid_num = int(file.stem.split('_')[0])
-            if vid_num not in self.vid_to_files:
-                self.vid_to_files[vid_num] = []
-            self.vid_to_files[vid_num].append(file)
-            
-        self.vid_nums = [int(f.stem.split('_')[0]) for f in self.video_files]
-        print("Max Video Number: ", max(self.vid_nums))
+        # {vid_num}_{segment_num}.mp4, parsed once
+        self.vid_nums = np.empty(len(self.video_files), dtype=np.int32)
+        self.segment_nums = np.empty(len(self.video_files), dtype=np.int32)
+        for i, file in enumerate(self.video_files):
+            vid_num, segment_num = file.stem.split('_')[:2]
+            self.vid_nums[i] = int(vid_num)
+            self.segment_nums[i] = int(segment_num)
+        print("Max Video Number: ", self.vid_nums.max())
+        self._load_metadata()
+
+    def _load_metadata(self):
+        """Per-file (fps, time_base, num_frames), probed once and cached next to the videos.
+        Cache entries carry the file's (size, mtime) and are re-probed when either changes.
+        Kept as arrays aligned with video_files, since the dataset is pickled into every worker."""
+        cache_path = self.data_root / 'metadata.pkl'
+        cache = {}
+        if cache_path.exists():
+            try:
+                with open(cache_path, 'rb') as f:
+                    cache = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError) as e:
+                print(f"Ignoring unreadable metadata cache {cache_path}: {e}")
+        with ThreadPoolExecutor(max_workers=64) as pool:
+            stats = [(st.st_size, st.st_mtime_ns) for st in pool.map(Path.stat, self.video_files)]
+            missing = []
+            for file, stat in zip(self.video_files, stats):
+                entry = cache.get(file.name)
+                if entry is None or entry[0] != stat:
+                    missing.append((file, stat))
+            if missing:
+                print(f"Probing metadata for {len(missing)} videos")
+                probed = pool.map(_probe_video, [file for file, _ in missing])
+                for (file, stat), meta in zip(missing, probed):
+                    cache[file.name] = (stat, meta)
+        if missing:
+            try:
+                # write then rename, so an interrupted write never leaves a truncated cache behind
+                temp_path = cache_path.with_suffix('.temp.pkl')
+                with open(temp_path, 'wb') as f:
+                    pickle.dump(cache, f)
+                temp_path.rename(cache_path)
+            except OSError as e:
+                print(f"Could not write metadata cache to {cache_path}: {e}")
+
+        self.fps = np.zeros(len(self.video_files), dtype=np.float32)
+        self.time_base_num = np.zeros(len(self.video_files), dtype=np.int32)
+        self.time_base_den = np.ones(len(self.video_files), dtype=np.int32)
+        self.num_frames = np.zeros(len(self.video_files), dtype=np.int32)
+        self.metadata_valid = np.zeros(len(self.video_files), dtype=bool)
+        for i, file in enumerate(self.video_files):
+            meta = cache[file.name][1]
+            if meta is None or meta[1] is None:
+                continue
+            fps, time_base, num_frames = meta
+            self.fps[i] = fps
+            self.time_base_num[i] = time_base.numerator
+            self.time_base_den[i] = time_base.denominator
+            self.num_frames[i] = num_frames
+            self.metadata_valid[i] = True
+
+    def _metadata(self, idx):
+        """(fps, time_base, num_frames) for load_av, or None if the file couldn't be probed."""
+        if not self.metadata_valid[idx]:
+            return None
+        return (
+            float(self.fps[idx]),
+            Fraction(int(self.time_base_num[idx]), int(self.time_base_den[idx])),
+            int(self.num_frames[idx]),
+        )
 
     def __len__(self):
         return len(self.video_files)
@@ -135,36 +269,40 @@ class AudioVisualDataset(Dataset):
     
         video_path = self.video_files[idx]
         try:
-            audio = extract_audio_from_video(video_path)
-            video_frame = load_and_preprocess_video(str(video_path), self.sample_fps)
+            video_frame, audio = load_av(
+                video_path, self.sample_fps, self.hwaccel, metadata=self._metadata(idx)
+            )
             return {
                 'video_path': str(video_path),
                 'video_frames': video_frame, 
                 'audio': audio,
-                'vid_num': int(video_path.stem.split('_')[0]),
-                'segment_num': int(video_path.stem.split('_')[1]),
+                'vid_num': int(self.vid_nums[idx]),
+                'segment_num': int(self.segment_nums[idx]),
             }
         except Exception as e:
             print(f"Error processing {self.video_files[idx]}: {str(e)}")
             return {
                 'video_path': str(self.video_files[idx]),
                 'video_frames': torch.zeros(3, 224, 224),
-                'audio': torch.zeros(16331),
+                'audio': torch.zeros(AUDIO_NUM_SAMPLES, dtype=torch.int16),
                 'vid_num': -1,
                 'segment_num': -1
             }
 
+def _stack(tensors):
+    out = None
+    if get_worker_info() is not None:
+        # in a worker, stack straight into shared memory so handing the batch to the main
+        # process doesn't copy it a second time (same trick as torch's default_collate)
+        elem = tensors[0]
+        storage = elem._typed_storage()._new_shared(len(tensors) * elem.numel(), device=elem.device)
+        out = elem.new(storage).resize_(len(tensors), *elem.shape)
+    return torch.stack(tensors, out=out)
+
 def collate_fn(batch):
-    video_tokens = torch.stack([item['video_frames'] for item in batch])
-    max_audio_len = max(item['audio'].shape[0] for item in batch)
-    audio_padded = torch.zeros(len(batch), max_audio_len)
-    for i, item in enumerate(batch):
-        audio_len = item['audio'].shape[0]
-        audio_padded[i, :audio_len] = item['audio']
-    
     return {
-        'frame': video_tokens,
-        'audio': audio_padded,
+        'frame': _stack([item['video_frames'] for item in batch]),
+        'audio': _stack([item['audio'] for item in batch]),
         'vid_nums': [item['vid_num'] for item in batch],
         'segment_nums': [item['segment_num'] for item in batch],
         'video_paths': [str(item['video_path']) for item in batch]
@@ -189,9 +327,10 @@ if __name__ == "__main__":
         batch_sampler=batch_sampler,
         num_workers=16,
         persistent_workers=True,
+        worker_init_fn=init_worker,
         pin_memory=True,
         collate_fn=collate_fn,
-        prefetch_factor=6
+        prefetch_factor=2
     )
     i=0
     while True:  
@@ -2,7 +2,7 @@ from pathlib import Path
 import torch
 from model import AudioVisualModel
 from viz import AudioVisualizer
-from dataset import extract_audio_from_video, load_and_preprocess_video
+from dataset import load_av, dequantize_audio
 import random
 import warnings
 warnings.filterwarnings("ignore")
@@ -36,8 +36,8 @@ def load_model(checkpoint_path=None, output_dir=None, device='cuda'):
 
 def generate_video(model, video_path, output_path, fps=50, device='cuda'):
     """Generate attention visualization video for a single video"""
-    audio = extract_audio_from_video(video_path).to(device)
-    video_frames = load_and_preprocess_video(str(video_path), sample_fps=20).to(device)
+    video_frames, audio = load_av(video_path, sample_fps=20, device=device)
+    audio = dequantize_audio(audio.to(device))
     audio = audio.unsqueeze(0)
     video_frames = video_frames.unsqueeze(0)
     visualizer = AudioVisualizer()
@@ -110,18 +110,13 @@ class AudioVisualModel(nn.Module):
     
     def compute_all_similarities(self, audio_feats, visual_feats):
         """Compute similarities between all pairs of audio and visual features in batch"""
-        B = audio_feats.shape[0]
-        
-        audio_feats = audio_feats.unsqueeze(1).expand(-1, B, -1, -1)
-        visual_feats = visual_feats.unsqueeze(0).expand(B, -1, -1, -1)
-        audio_feats = F.normalize(audio_feats, dim=-1)
+        # normalize once per clip rather than on B-times expanded copies, and fold the
+        # temperature into the (smaller) audio side
+        audio_feats = F.normalize(audio_feats, dim=-1) / self.temperature
         visual_feats = F.normalize(visual_feats, dim=-1)
         
-        # token-level similarities
-        token_sims = torch.matmul(
-            audio_feats, 
-            visual_feats.transpose(2, 3)
-        ) / self.temperature
+        # token-level similarities (B, B, Na, Nv) as a single GEMM
+        token_sims = torch.einsum('and,bvd->abnv', audio_feats, visual_feats)
         max_sims = torch.max(token_sims, dim=3)[0]  # Max over visual dimension (B, B, Na)
         clip_sims = torch.mean(max_sims, dim=2)     # Mean over audio dimension (B, B)
         
@@ -7,7 +7,7 @@ import wandb
 import torch.nn as nn
 import torchvision.transforms as transforms
 from model import AudioVisualModel
-from dataset import AudioVisualDataset, VideoBatchSampler
+from dataset import AudioVisualDataset, VideoBatchSampler, collate_fn, dequantize_audio, init_worker
 from viz import AudioVisualizer
 import numpy as np
 import matplotlib.pyplot as plt
@@ -18,9 +18,92 @@ from pathlib import Path
 import yaml
 import argparse
 import time
+import math
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 warnings.filterwarnings("ignore")
 torch.cuda.empty_cache()
-
+# let matmuls left in fp32 outside autocast (e.g. visualization) use TF32 tensor cores
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.set_float32_matmul_precision('high')
+
+
+def snapshot_to_cpu(obj):
+    """Copy every tensor in a nested state dict to CPU so training can keep updating the originals."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def one_cycle_factor(step, total_steps, pct_start, div_factor, final_div_factor):
+    """Multiplier on max_lr that OneCycleLR (cosine, two-phase) would apply at `step`."""
+    warmup_end = pct_start * total_steps - 1
+    if step <= warmup_end:
+        start, end, pct = 1 / div_factor, 1.0, step / warmup_end if warmup_end > 0 else 1.0
+    else:
+        start, end = 1.0, 1 / (div_factor * final_div_factor)
+        pct = min((step - warmup_end) / (total_steps - 1 - warmup_end), 1.0)
+    return end + (start - end) / 2 * (math.cos(math.pi * pct) + 1)
+
+class CUDAPrefetcher:
+    """Iterates a dataloader as (frames, audio) on device, copying the next batch on a side
+    stream while the current one is in use."""
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = device
+        self.memcpy_stream = torch.cuda.Stream(device=device)
+        self._len = len(dataloader)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        self._batches = iter(self.dataloader)
+        self._preload()
+        return self
+
+    def _preload(self):
+        batch = next(self._batches, None)
+        if batch is None:
+            self._next = None
+            return
+        with torch.cuda.stream(self.memcpy_stream):
+            # NHWC for the ViT patch-embedding conv; relaid out on device, off the compute stream
+            frames = batch['frame'].to(self.device, non_blocking=True).contiguous(memory_format=torch.channels_last)
+            audio = dequantize_audio(batch['audio'].to(self.device, non_blocking=True))
+        self._next = (frames, audio)
+
+    def __next__(self):
+        if self._next is None:
+            raise StopIteration
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_stream(self.memcpy_stream)
+        frames, audio = self._next
+        # allocated on memcpy_stream, used on the compute stream
+        frames.record_stream(compute_stream)
+        audio.record_stream(compute_stream)
+        self._preload()
+        return frames, audio
+
+class DeviceLoader:
+    """Iterates a dataloader as (frames, audio) on a non-CUDA device with plain copies."""
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = device
+        self._len = len(dataloader)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for batch in self.dataloader:
+            frames = batch['frame'].to(self.device).contiguous(memory_format=torch.channels_last)
+            audio = dequantize_audio(batch['audio'].to(self.device))
+            yield frames, audio
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Train audio-visual model')
@@ -32,23 +115,6 @@ def load_config(config_path):
         config = yaml.safe_load(f)
     return config
 
-def collate_fn(batch):
-    # Get all tokens (already processed)
-    video_tokens = torch.stack([item['video_frames'] for item in batch])
-    max_audio_len = max(item['audio'].shape[0] for item in batch)
-    audio_padded = torch.zeros(len(batch), max_audio_len)
-    for i, item in enumerate(batch):
-        audio_len = item['audio'].shape[0]
-        audio_padded[i, :audio_len] = item['audio']
-    
-    return {
-        'frame': video_tokens,
-        'audio': audio_padded,
-        'vid_nums': [item['vid_num'] for item in batch],
-        'segment_nums': [item['segment_num'] for item in batch],
-        'video_paths': [str(item['video_path']) for item in batch]  
-    }
-
 class AudioVisualTrainer:
     def __init__(
         self,
@@ -77,6 +143,7 @@ class AudioVisualTrainer:
             'learning_rate': config['training']['learning_rate'],
             'num_epochs': config['training']['num_epochs'],
             'num_workers': config['training']['num_workers'],
+            'prefetch_factor': config['training'].get('prefetch_factor', 2),
             'gradient_accumulation_steps': config['training']['gradient_accumulation_steps'],
             'save_every_steps': config['training']['save_every_steps'],
             'unfreeze_hubert_epoch': config['model']['unfreeze_hubert_epoch'],
@@ -87,7 +154,12 @@ class AudioVisualTrainer:
         
         # Set class attributes
         self.vis_every = config['visualization']['vis_every']
+        # .item() syncs with the GPU and wandb.log crosses a socket, so both only happen this often
+        self.log_every = config['training'].get('log_every', 50)
         self.device = config['training'].get('device', 'cuda')
+        # side-stream prefetch, pinned memory and mixed precision are CUDA-only
+        self.device_type = torch.device(self.device).type
+        self.use_cuda = self.device_type == 'cuda'
         self.use_wandb = config['wandb']['enabled']
         self.num_vis_samples = config['visualization']['num_vis_samples']
         self.gradient_accumulation_steps = config['training']['gradient_accumulation_steps']
@@ -106,7 +178,8 @@ class AudioVisualTrainer:
 
         self.dataset = AudioVisualDataset(
             data_root=config['training']['video_dir'],
-            sample_fps=20
+            sample_fps=20,
+            hwaccel=config['training'].get('hwaccel', False)
         )
 
         self.batch_sampler = VideoBatchSampler(
@@ -119,16 +192,28 @@ class AudioVisualTrainer:
             batch_sampler=self.batch_sampler,
             num_workers=self.config['num_workers'],
             persistent_workers=True,
-            pin_memory=True,
+            worker_init_fn=init_worker,
+            pin_memory=self.use_cuda,
             collate_fn=collate_fn,
-            prefetch_factor=6
+            prefetch_factor=self.config['prefetch_factor']
         )
+        # batches per epoch are fixed by the sampler; count them once
+        self._dl_len = len(self.dataloader)
         
-        # Initially freeze
-        for param in self.model.visual_embedder.model.parameters():
-            param.requires_grad = False
-        for param in self.model.audio_embedder.hubert.parameters():
-            param.requires_grad = False
+        self.model = AudioVisualModel().to(self.device)
+        # matches the channels_last frames from CUDAPrefetcher
+        self.model.visual_embedder.model.to(memory_format=torch.channels_last)
+        # training steps go through train_model; self.model stays the eager module so state dicts
+        # and visualization are unaffected
+        self.train_model = self.model
+        if config['model'].get('compile', False):
+            # each freeze/unfreeze (requires_grad change) guards a new graph; keep them all cached.
+            # train_model only ever runs in train mode, since visualization uses the eager self.model
+            torch._dynamo.config.cache_size_limit = 64
+            self.train_model = torch.compile(
+                self.model, mode=config['model'].get('compile_mode', 'max-autotune')
+            )
+
         projection_params = []
         temperature_params = []
         hubert_params = []
@@ -145,32 +230,54 @@ class AudioVisualTrainer:
                 temperature_params.append(param)
             else:
                 projection_params.append(param)
+        # reused by the freeze toggles instead of walking the module tree again
+        self._hubert_params = hubert_params
+        self._vit_params = vit_params
 
-        self.optimizer_projection = torch.optim.AdamW(
+        # Initially freeze
+        for param in self._vit_params + self._hubert_params:
+            param.requires_grad = False
+
+        # one optimizer for everything; frozen params have no grad and are skipped by the step.
+        # group lrs are the peak lrs the scheduler scales
+        self.optimizer = torch.optim.AdamW(
             [
-                {'params': projection_params, 'lr': 1e-3},
-                {'params': temperature_params, 'lr': 1e-3},
-            ]
+                {'params': projection_params, 'lr': self.config['learning_rate']},
+                {'params': temperature_params, 'lr': self.config['learning_rate']},
+                {'params': hubert_params, 'lr': 1e-5},
+                {'params': vit_params, 'lr': 1e-5},
+            ],
+            fused=self.use_cuda
         )
-        self.optimizer_hubert = torch.optim.AdamW(
-            [{'params': hubert_params, 'lr': 8e-5}]
-        )
-        self.optimizer_vit = torch.optim.AdamW(
-            [{'params': vit_params, 'lr': 8e-5}]
+        # per-group one-cycle schedules: projection/temperature over the whole run, each backbone
+        # over the steps left once it unfreezes (lr 0 until then)
+        self.scheduler = torch.optim.lr_scheduler.LambdaLR(
+            self.optimizer,
+            lr_lambda=[
+                self._projection_lr_factor,
+                self._projection_lr_factor,
+                lambda step: self._backbone_lr_factor(step, self.config['unfreeze_hubert_epoch']),
+                lambda step: self._backbone_lr_factor(step, self.config['unfreeze_vit_epoch']),
+            ]
         )
 
-        num_training_steps = len(self.dataloader) * self.config['num_epochs']
-        self.scheduler_projection = torch.optim.lr_scheduler.OneCycleLR(
-            self.optimizer_projection,
-            max_lr=self.config['learning_rate'],
-            total_steps=num_training_steps,
-            pct_start=0.015,
-            div_factor=10,
-            final_div_factor=1e4,
-            anneal_strategy='cos'
-        )
-        self.scheduler_hubert = None
-        self.scheduler_vit = None
+        # bf16 autocast on Ampere+ needs no loss scaling; the fp16 fallback goes through the scaler.
+        # other devices train in fp32 with autocast and the scaler disabled
+        if self.use_cuda:
+            with torch.cuda.device(self.device):
+                self.amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        else:
+            self.amp_dtype = torch.bfloat16
+        self.scaler = torch.amp.GradScaler('cuda', enabled=self.amp_dtype == torch.float16)
+
+        self._save_executor = ThreadPoolExecutor(max_workers=1)
+        self._save_future = None
+        atexit.register(self._save_executor.shutdown, wait=True)
+
+        if self.use_cuda:
+            self.prefetcher = CUDAPrefetcher(self.dataloader, self.device)
+        else:
+            self.prefetcher = DeviceLoader(self.dataloader, self.device)
 
         self.visualizer = AudioVisualizer()
 
@@ -220,10 +327,9 @@ class AudioVisualTrainer:
             'epoch': epoch,
             'step': step,
             'model_state_dict': self.model.state_dict(),
-            'optimizer_projection_state_dict': self.optimizer_projection.state_dict(),
-            'scheduler_projection_state_dict': self.scheduler_projection.state_dict() if self.scheduler_projection is not None else None,
-            'optimizer_hubert_state_dict': self.optimizer_hubert.state_dict(),
-            'optimizer_vit_state_dict': self.optimizer_vit.state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),
+            'scheduler_state_dict': self.scheduler.state_dict(),
+            'scaler_state_dict': self.scaler.state_dict(),
             'best_loss': self.best_loss,
             'config': self.config,
             'vis_samples': {
@@ -233,24 +339,27 @@ class AudioVisualTrainer:
             }
         }
 
-        if self.scheduler_hubert is not None:
-            checkpoint['scheduler_hubert_state_dict'] = self.scheduler_hubert.state_dict()
-        else:
-            checkpoint['scheduler_hubert_state_dict'] = None
-
-        if self.scheduler_vit is not None:
-            checkpoint['scheduler_vit_state_dict'] = self.scheduler_vit.state_dict()
-        else:
-            checkpoint['scheduler_vit_state_dict'] = None
-
         if self.use_wandb and wandb.run is not None:
             checkpoint['wandb_run_id'] = wandb.run.id
 
-        temp_path = checkpoint_path.with_suffix('.temp.pt')
-        torch.save(checkpoint, temp_path)
-        temp_path.rename(checkpoint_path)
-        self.logger.info(f'Saved checkpoint to {checkpoint_path}')
-        print(f"Saved checkpoint for epoch {epoch} and step {step}.")
+        # at most one save in flight, so CPU snapshots can't pile up behind a slow disk
+        if self._save_future is not None:
+            self._save_future.result()
+        # snapshot on this thread, serialize and write in the background
+        self._save_future = self._save_executor.submit(
+            self._write_checkpoint, snapshot_to_cpu(checkpoint), checkpoint_path
+        )
+
+    def _write_checkpoint(self, checkpoint, checkpoint_path):
+        try:
+            temp_path = checkpoint_path.with_suffix('.temp.pt')
+            torch.save(checkpoint, temp_path)
+            temp_path.rename(checkpoint_path)
+            self.logger.info(f'Saved checkpoint to {checkpoint_path}')
+            print(f"Saved checkpoint for epoch {checkpoint['epoch']} and step {checkpoint['step']}.")
+        except Exception as e:
+            self.logger.error(f'Failed to save checkpoint {checkpoint_path}: {e}')
+            print(f"Failed to save checkpoint {checkpoint_path}: {e}")
 
     def load_checkpoint(self, checkpoint_path: str):
         print(f"Loading checkpoint from {checkpoint_path}")
@@ -261,16 +370,23 @@ class AudioVisualTrainer:
         self.global_step = checkpoint['step']
         self.best_loss = checkpoint['best_loss']
         self.config.update(checkpoint.get('config', {}))
-        self.optimizer_projection.load_state_dict(checkpoint['optimizer_projection_state_dict'])
-        if checkpoint.get('scheduler_projection_state_dict') is not None:
-            self.scheduler_projection.load_state_dict(checkpoint['scheduler_projection_state_dict'])
-        self.optimizer_hubert.load_state_dict(checkpoint['optimizer_hubert_state_dict'])
-        self.optimizer_vit.load_state_dict(checkpoint['optimizer_vit_state_dict'])
+        if 'optimizer_state_dict' in checkpoint:
+            self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+            self.scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        else:
+            # per-module optimizer state can't be mapped onto the groups; start it fresh but put
+            # the lr schedule back where the run left off
+            print("Checkpoint has per-module optimizers; starting optimizer state fresh")
+            self.scheduler.last_epoch = self.global_step // self.gradient_accumulation_steps
+            for group, base_lr, lr_lambda in zip(self.optimizer.param_groups, self.scheduler.base_lrs, self.scheduler.lr_lambdas):
+                group['lr'] = base_lr * lr_lambda(self.scheduler.last_epoch)
+        if checkpoint.get('scaler_state_dict'):
+            self.scaler.load_state_dict(checkpoint['scaler_state_dict'])
 
         if 'vis_samples' in checkpoint:
             self.vis_samples = {
-                'frames': checkpoint['vis_samples']['frames'].to(self.device),
-                'audios': checkpoint['vis_samples']['audios'].to(self.device),
+                'frames': self._pin(checkpoint['vis_samples']['frames'].cpu()),
+                'audios': self._pin(checkpoint['vis_samples']['audios'].cpu()),
                 'video_paths': checkpoint['vis_samples']['video_paths']
             }
         
@@ -289,53 +405,40 @@ class AudioVisualTrainer:
                     config=self.config
                 )
 
-        current_epoch = self.start_epoch
-        dataloader_len = len(self.dataloader)
-        if (checkpoint.get('scheduler_hubert_state_dict') is not None) and (checkpoint['scheduler_hubert_state_dict'] is not None):
-            self.scheduler_hubert = torch.optim.lr_scheduler.OneCycleLR(
-                self.optimizer_hubert,
-                max_lr=6e-5,
-                total_steps=(self.config['num_epochs'] - self.config['unfreeze_hubert_epoch']) * dataloader_len,
-                pct_start=0.1,
-                div_factor=10,
-                final_div_factor=1e4,
-                anneal_strategy='cos'
-            )
-            self.scheduler_hubert.load_state_dict(checkpoint['scheduler_hubert_state_dict'])
-
-        if (checkpoint.get('scheduler_vit_state_dict') is not None) and (checkpoint['scheduler_vit_state_dict'] is not None):
-            self.scheduler_vit = torch.optim.lr_scheduler.OneCycleLR(
-                self.optimizer_vit,
-                max_lr=6e-5,
-                total_steps=(self.config['num_epochs'] - self.config['unfreeze_vit_epoch']) * dataloader_len,
-                pct_start=0.1,
-                div_factor=10,
-                final_div_factor=1e4,
-                anneal_strategy='cos'
-            )
-            self.scheduler_vit.load_state_dict(checkpoint['scheduler_vit_state_dict'])
         self._set_freeze_state(self.start_epoch)
 
         print(f"Resumed from epoch {self.start_epoch} (step {self.global_step})")
 
     def _get_visualization_samples(self):
-        batch = next(iter(self.dataloader))
-        indices = torch.randperm(len(batch['frame']))[:self.num_vis_samples]
+        # read straight from the dataset; pulling a batch through the dataloader would start
+        # all of its workers just to throw the iterator away
+        indices = torch.randperm(len(self.dataset))[:self.num_vis_samples].tolist()
+        batch = collate_fn([self.dataset[i] for i in indices])
         vis_samples = {
-            'frames': batch['frame'][indices].to(self.device),
-            'audios': batch['audio'][indices].to(self.device),
-            'video_paths': [batch['video_paths'][i] for i in indices]
+            'frames': self._pin(batch['frame']),
+            'audios': self._pin(dequantize_audio(batch['audio'])),
+            'video_paths': batch['video_paths']
         }
         return vis_samples
 
+    def _pin(self, tensor):
+        return tensor.pin_memory() if self.use_cuda else tensor
+
+    def _vis_sample(self, i: int):
+        # vis samples live in pinned host memory; only the one being rendered goes to the GPU
+        frame = self.vis_samples['frames'][i:i+1].to(self.device, non_blocking=True)
+        audio = self.vis_samples['audios'][i:i+1].to(self.device, non_blocking=True)
+        return frame, audio
+
     def create_visualization(self, epoch: int, step: int):
         try:
             fig, axes = plt.subplots(self.num_vis_samples, 5, figsize=(20, 4*self.num_vis_samples))
             for i in range(self.num_vis_samples):
+                frame, audio = self._vis_sample(i)
                 self.visualizer.plot_attention_snapshot(
                     self.model,
-                    self.vis_samples['frames'][i:i+1],
-                    self.vis_samples['audios'][i:i+1],
+                    frame,
+                    audio,
                     num_timesteps=5,
                     axes=axes[i] if self.num_vis_samples > 1 else axes
                 )
@@ -345,61 +448,62 @@ class AudioVisualTrainer:
                         "epoch": epoch,
                         "step": step
                     })
-                torch.cuda.empty_cache()
             plt.close('all')
 
             if epoch % 1 == 0:
                 print(f"Saving attention videos for epoch {epoch}")
                 for i in range(self.num_vis_samples):
                     video_path = self.output_dir / f'attention_epoch{epoch}_sample{i}.mp4'
-                    torch.cuda.empty_cache()
-                    gc.collect()
+                    frame, audio = self._vis_sample(i)
                     self.visualizer.make_attention_video(
                         self.model,
-                        self.vis_samples['frames'][i:i+1],
-                        self.vis_samples['audios'][i:i+1],
+                        frame,
+                        audio,
                         video_path,
                         video_path=self.vis_samples['video_paths'][i]
                     )
-                    torch.cuda.empty_cache()
-                    gc.collect()
 
         finally:
+            # the visualizer switches the model to eval mode; restore it for the rest of the epoch
+            self.model.train()
             plt.close('all')
+            # once, after rendering, to hand back the visualization's eval-mode activations
             torch.cuda.empty_cache()
 
+    def _optimizer_steps(self, num_epochs: int):
+        """Optimizer (and scheduler) steps taken over the first `num_epochs` epochs."""
+        return num_epochs * self._dl_len // self.gradient_accumulation_steps
+
+    def _projection_lr_factor(self, step: int):
+        return one_cycle_factor(
+            step,
+            total_steps=self._optimizer_steps(self.config['num_epochs']),
+            pct_start=0.015,
+            div_factor=10,
+            final_div_factor=1e4
+        )
+
+    def _backbone_lr_factor(self, step: int, unfreeze_epoch: int):
+        # the backbone's cycle runs from the first optimizer step of its unfreeze epoch to the end
+        start = self._optimizer_steps(unfreeze_epoch)
+        if step < start:
+            return 0.0
+        return one_cycle_factor(
+            step - start,
+            total_steps=self._optimizer_steps(self.config['num_epochs']) - start,
+            pct_start=0.1,
+            div_factor=10,
+            final_div_factor=1e4
+        )
+
     def _set_freeze_state(self, current_epoch: int):
-        dataloader_len = len(self.dataloader)
-        
         if current_epoch >= self.config['unfreeze_hubert_epoch']:
-            for param in self.model.audio_embedder.hubert.parameters():
+            for param in self._hubert_params:
                 param.requires_grad = True
-            if self.scheduler_hubert is None:
-                steps_remaining_hubert = (self.config['num_epochs'] - current_epoch) * dataloader_len
-                self.scheduler_hubert = torch.optim.lr_scheduler.OneCycleLR(
-                    self.optimizer_hubert,
-                    max_lr=1e-5,
-                    total_steps=steps_remaining_hubert,
-                    pct_start=0.1,
-                    div_factor=10,
-                    final_div_factor=1e4,
-                    anneal_strategy='cos'
-                )
 
         if current_epoch >= self.config['unfreeze_vit_epoch']:
-            for param in self.model.visual_embedder.model.parameters():
+            for param in self._vit_params:
                 param.requires_grad = True
-            if self.scheduler_vit is None:
-                steps_remaining_vit = (self.config['num_epochs'] - current_epoch) * dataloader_len
-                self.scheduler_vit = torch.optim.lr_scheduler.OneCycleLR(
-                    self.optimizer_vit,
-                    max_lr=1e-5,
-                    total_steps=steps_remaining_vit,
-                    pct_start=0.1,
-                    div_factor=10,
-                    final_div_factor=1e4,
-                    anneal_strategy='cos'
-                )
 
     def train(self, num_epochs: int = None):
         if num_epochs is not None:
@@ -407,80 +511,71 @@ class AudioVisualTrainer:
 
         accumulation_counter = 0
         total_epochs = self.config['num_epochs']
-        dataloader_len = len(self.dataloader)
 
         for epoch in range(self.start_epoch, total_epochs):
             self._set_freeze_state(epoch)
             print(f"Epoch {epoch}")
             self.model.train()
-            epoch_losses = []
-
-            print("Training the following layers:")
-            for name, param in self.model.named_parameters():
-                if param.requires_grad:
-                    print(f"  {name}")
-            pbar = tqdm(self.dataloader, desc=f'Epoch {epoch}')
-
-            for batch in pbar:
-                self.model.train()
-                frames = batch['frame'].to(self.device)
-                audio = batch['audio'].to(self.device)
-                loss = self.model(frames, audio)
-
-                if loss.item() > 10:
-                    print(f"Skipping batch with loss: {loss.item():.4f}")
-                    continue
+            # running kept-batch loss for the epoch, summed on device
+            epoch_loss_sum = torch.zeros((), device=self.device)
+            epoch_loss_count = torch.zeros((), dtype=torch.long, device=self.device)
+            epoch_skipped = torch.zeros((), dtype=torch.long, device=self.device)
+            # kept-batch loss since the last log, summed on device
+            log_loss_sum = torch.zeros((), device=self.device)
+            log_loss_count = torch.zeros((), dtype=torch.long, device=self.device)
+
+            if epoch in (self.start_epoch, self.config['unfreeze_hubert_epoch'], self.config['unfreeze_vit_epoch']):
+                print("Training the following layers:")
+                for name, param in self.model.named_parameters():
+                    if param.requires_grad:
+                        print(f"  {name}")
+            pbar = tqdm(self.prefetcher, desc=f'Epoch {epoch}')
+
+            for frames, audio in pbar:
+                with torch.autocast(device_type=self.device_type, dtype=self.amp_dtype, enabled=self.use_cuda):
+                    loss = self.train_model(frames, audio)
+
+                # zero out outlier batches on device rather than syncing on loss.item() every step
+                batch_loss = loss.detach()
+                kept = batch_loss <= 10
+                loss = torch.where(kept, loss, torch.zeros_like(loss))
+                kept_loss = torch.where(kept, batch_loss, torch.zeros_like(batch_loss))
+                epoch_loss_sum += kept_loss
+                epoch_loss_count += kept
+                epoch_skipped += ~kept
 
                 loss = loss / self.gradient_accumulation_steps
-                loss.backward()
+                self.scaler.scale(loss).backward()
                 
                 accumulation_counter += 1
 
                 if accumulation_counter % self.gradient_accumulation_steps == 0:
+                    self.scaler.unscale_(self.optimizer)
                     torch.nn.utils.clip_grad_norm_(self.model.parameters(), 0.5)
-
-                    self.optimizer_projection.step()
-                    self.scheduler_projection.step()
-                    self.optimizer_projection.zero_grad()
-
-                    if epoch >= self.config['unfreeze_hubert_epoch']:
-                        self.optimizer_hubert.step()
-                        self.scheduler_hubert.step()
-                        self.optimizer_hubert.zero_grad()
-
-                    if epoch >= self.config['unfreeze_vit_epoch']:
-                        self.optimizer_vit.step()
-                        self.scheduler_vit.step()
-                        self.optimizer_vit.zero_grad()
-
-                loss_value = loss.item() * self.gradient_accumulation_steps
-                epoch_losses.append(loss_value)
-                pbar.set_postfix({'loss': f'{loss_value:.4f}'})
-
-                if self.use_wandb:
-                    log_dict = {
-                        "train_loss": loss_value,
-                        "projection_lr": self.optimizer_projection.param_groups[0]['lr'],
-                        "temperature": self.model.temperature.item()
-                    }
-                    if epoch >= self.config['unfreeze_hubert_epoch']:
-                        log_dict["hubert_lr"] = self.optimizer_hubert.param_groups[0]['lr']
-                    else:
-                        log_dict["hubert_lr"] = 0
-                    if epoch >= self.config['unfreeze_vit_epoch']:
-                        log_dict["vit_lr"] = self.optimizer_vit.param_groups[0]['lr']
-                    else:
-                        log_dict["vit_lr"] = 0
-                    
-                    log_dict["epoch"] = epoch
-                    log_dict["step"] = self.global_step
-                    wandb.log(log_dict)
-
-                del frames, audio, loss
-                torch.cuda.empty_cache()
-
-                if self.global_step % 500 == 0:
-                    gc.collect()
+                    self.scaler.step(self.optimizer)
+                    self.scheduler.step()
+                    self.optimizer.zero_grad(set_to_none=True)
+                    self.scaler.update()
+
+                log_loss_sum += kept_loss
+                log_loss_count += kept
+                if self.global_step % self.log_every == 0:
+                    loss_value = (log_loss_sum / log_loss_count.clamp(min=1)).item()
+                    log_loss_sum.zero_()
+                    log_loss_count.zero_()
+                    pbar.set_postfix({'loss': f'{loss_value:.4f}'})
+
+                    if self.use_wandb:
+                        log_dict = {
+                            "train_loss": loss_value,
+                            "projection_lr": self.optimizer.param_groups[0]['lr'],
+                            "hubert_lr": self.optimizer.param_groups[2]['lr'],
+                            "vit_lr": self.optimizer.param_groups[3]['lr'],
+                            "temperature": self.model.temperature.item()
+                        }
+                        log_dict["epoch"] = epoch
+                        log_dict["step"] = self.global_step
+                        wandb.log(log_dict)
 
                 if self.global_step % self.vis_every == 0:
                     with torch.no_grad():
@@ -493,14 +588,16 @@ class AudioVisualTrainer:
 
                 self.global_step += 1
 
-            epoch_loss = np.mean(epoch_losses)
+            epoch_loss = (epoch_loss_sum / epoch_loss_count.clamp(min=1)).item()
             self.logger.info(f'Epoch {epoch} - Loss: {epoch_loss:.4f}')
+            if epoch_skipped.item() > 0:
+                print(f"Skipped {epoch_skipped.item()} batches with loss > 10")
 
             if self.use_wandb:
                 wandb.log({
                     'epoch_loss': epoch_loss,
                     'epoch': epoch,
-                    'projection_lr': self.optimizer_projection.param_groups[0]['lr'],
+                    'projection_lr': self.optimizer.param_groups[0]['lr'],
                 })
             self.save_checkpoint(epoch, self.global_step)
 